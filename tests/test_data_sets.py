@@ -14,6 +14,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import pickle
+import torch
 from sklearn.preprocessing import StandardScaler
 from torchhydro.datasets.data_sets import BaseDataset
 from torchhydro.datasets.data_sources import data_sources_dict
@@ -72,7 +73,8 @@ class MockDatasource:
         return xr.Dataset(data_vars=data_vars, coords={"basin": basins})
 
 
-def test_create_lookup_table(tmp_path):
+@pytest.fixture()
+def mock_data_cfgs(tmp_path):
     temp_test_path = tmp_path / "test_datasets"
     os.makedirs(temp_test_path, exist_ok=True)
     data_sources_dict.update({"mockdatasource": MockDatasource})
@@ -123,16 +125,11 @@ def test_create_lookup_table(tmp_path):
         "scaler": "StandardScaler",  # Add the scaler configuration here
         "stat_dict_file": None,  # Added the missing configuration
     }
-    is_tra_val_te = "train"
-    dataset = BaseDataset(data_cfgs, is_tra_val_te)
-    lookup_table = dataset.lookup_table
-    assert isinstance(lookup_table, dict)
-    assert len(lookup_table) > 0
-    assert all(
-        isinstance(key, int) and isinstance(value, tuple)
-        for key, value in lookup_table.items()
-    )
-    is_tra_val_te = "test"
+    return data_cfgs
+
+
+def _set_stat_dict_file(data_cfgs, tmp_path):
+    """Save a fitted scaler to the stat_dict_file, which valid/test datasets need"""
     mock_data = np.random.rand(100, 2)  # Replace with relevant data.
     scaler = StandardScaler()
     scaler.fit(mock_data)
@@ -140,11 +137,90 @@ def test_create_lookup_table(tmp_path):
     data_cfgs["stat_dict_file"] = str(scaler_file_path)
     with open(scaler_file_path, "wb") as file:
         pickle.dump(scaler, file)
+
+
+def test_create_lookup_table(mock_data_cfgs, tmp_path):
+    data_cfgs = mock_data_cfgs
+    is_tra_val_te = "train"
     dataset = BaseDataset(data_cfgs, is_tra_val_te)
     lookup_table = dataset.lookup_table
-    assert isinstance(lookup_table, dict)
+    assert isinstance(lookup_table, np.ndarray)
+    assert lookup_table.dtype == np.int32
+    assert lookup_table.shape == (dataset.num_samples, 2)
     assert len(lookup_table) > 0
-    assert all(
-        isinstance(key, int) and isinstance(value, tuple)
-        for key, value in lookup_table.items()
+    is_tra_val_te = "test"
+    _set_stat_dict_file(data_cfgs, tmp_path)
+    dataset = BaseDataset(data_cfgs, is_tra_val_te)
+    lookup_table = dataset.lookup_table
+    assert isinstance(lookup_table, np.ndarray)
+    assert lookup_table.dtype == np.int32
+    assert lookup_table.shape == (dataset.num_samples, 2)
+    assert len(lookup_table) > 0
+
+
+class DoubledInputDataset(BaseDataset):
+    """A dataset overriding __getitem__, so __getitems__ has to fall back to it"""
+
+    def __getitem__(self, item):
+        xc, y = super().__getitem__(item)
+        return xc * 2, y
+
+
+def _assert_getitems_same_as_getitem(dataset, indices):
+    batch = dataset.__getitems__(indices)
+    assert len(batch) == len(indices)
+    for (xc, y), i in zip(batch, indices):
+        torch.testing.assert_close(xc, dataset[i][0])
+        torch.testing.assert_close(y, dataset[i][1])
+
+
+def test_getitems(mock_data_cfgs, tmp_path):
+    data_cfgs = mock_data_cfgs
+    dataset = BaseDataset(data_cfgs, "train")
+    assert dataset.xc.flags["C_CONTIGUOUS"] and dataset.y.flags["C_CONTIGUOUS"]
+    assert dataset.xc.dtype == np.float32 and dataset.y.dtype == np.float32
+    np.testing.assert_array_equal(dataset.xc[:, 0, dataset.x.shape[-1] :], dataset.c)
+    _assert_getitems_same_as_getitem(dataset, [0, dataset.num_samples - 1, 3])
+    # valid/test datasets index the whole-period tensors directly
+    _set_stat_dict_file(data_cfgs, tmp_path)
+    dataset = BaseDataset(data_cfgs, "test")
+    indices = [1, 0]
+    batch = dataset.__getitems__(indices)
+    torch.testing.assert_close(
+        torch.stack([xc for xc, _ in batch]), dataset._xc_tensor[indices]
+    )
+    torch.testing.assert_close(
+        torch.stack([y for _, y in batch]), dataset._y_tensor[indices]
+    )
+    _assert_getitems_same_as_getitem(dataset, indices)
+    # subclasses overriding __getitem__ get their own samples
+    dataset = DoubledInputDataset(data_cfgs, "test")
+    _assert_getitems_same_as_getitem(dataset, indices)
+    torch.testing.assert_close(
+        dataset.__getitems__(indices)[0][0], dataset._xc_tensor[1] * 2
+    )
+
+
+def test_preprocessed_cache(mock_data_cfgs, tmp_path):
+    data_cfgs = mock_data_cfgs
+    data_cfgs["preprocessed_cache_dir"] = str(tmp_path / "preprocessed")
+    dataset = BaseDataset(data_cfgs, "train")
+    # another run of a sweep, only differing in settings not used by preprocessing
+    test_path = tmp_path / "another_run"
+    os.makedirs(test_path)
+    another_cfgs = {**data_cfgs, "test_path": str(test_path), "batch_size": 64}
+    cached = BaseDataset(another_cfgs, "train")
+    # files are written to temporary ones and moved into place
+    assert not any(
+        f.endswith(".tmp") for f in os.listdir(data_cfgs["preprocessed_cache_dir"])
     )
+    # the mock data source returns random data, so equal arrays come from the cache
+    assert isinstance(cached.xc, np.memmap)
+    np.testing.assert_array_equal(cached.xc, dataset.xc)
+    np.testing.assert_array_equal(cached.y, dataset.y)
+    for name in ["target_vars", "relevant_vars", "constant_vars"]:
+        assert os.path.isfile(test_path / f"{name}_scaler.pkl")
+    # valid/test datasets of that run find the statistics in its test_path
+    BaseDataset(another_cfgs, "test")
+    another_cfgs["relevant_rm_nan"] = False
+    assert not isinstance(BaseDataset(another_cfgs, "train").xc, np.memmap)
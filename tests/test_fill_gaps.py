@@ -0,0 +1,147 @@
+"""
+Test filling gaps of time-series and attribute data in datasets
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from torchhydro.datasets.data_sets import _fill_gaps_da
+
+
+@pytest.fixture()
+def ts_da():
+    """A (variable, basin, time) DataArray with gaps, the time axis is not evenly spaced"""
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2001-01-01", periods=40, freq="D").delete([5, 6, 20])
+    data = rng.random((2, 4, len(times)))
+    data[rng.random(data.shape) < 0.3] = np.nan
+    # gaps at both ends so extrapolation is needed
+    data[0, 0, :3] = np.nan
+    data[1, 2, -4:] = np.nan
+    return xr.DataArray(
+        data,
+        dims=("variable", "basin", "time"),
+        coords={
+            "variable": ["prcp", "pet"],
+            "basin": ["b0", "b1", "b2", "b3"],
+            "time": times,
+        },
+    )
+
+
+def test_fill_gaps_interpolate(ts_da):
+    expected = ts_da.interpolate_na(dim="time", fill_value="extrapolate")
+    result = _fill_gaps_da(ts_da.copy(), fill_nan="interpolate")
+    assert result.dims == ts_da.dims
+    np.testing.assert_allclose(result.values, expected.values)
+
+
+def test_fill_gaps_et_ssm_ignore(ts_da):
+    ts_da[:, :, [8, 9, 30]] = np.nan
+    # the dates without data in any basin are kept as NaN
+    expected = ts_da.copy()
+    non_nan_idx = np.where((~np.isnan(ts_da.values)).any(axis=(0, 1)))[0]
+    expected[dict(time=non_nan_idx)] = expected.isel(time=non_nan_idx).interpolate_na(
+        dim="time", fill_value="extrapolate"
+    )
+    result = _fill_gaps_da(ts_da.copy(), fill_nan="et_ssm_ignore")
+    np.testing.assert_allclose(result.values, expected.values)
+    assert np.isnan(result.values[:, :, [8, 9, 30]]).all()
+
+
+def test_fill_gaps_interpolate_single_valid_and_all_nan(ts_da):
+    ts_da[0, 1, :] = np.nan
+    ts_da[0, 1, 10] = 0.5
+    ts_da[1, 3, :] = np.nan
+    result = _fill_gaps_da(ts_da.copy(), fill_nan="interpolate")
+    # one valid value is not enough for scipy, we fill the row with it
+    np.testing.assert_array_equal(result.values[0, 1], 0.5)
+    # nothing to interpolate from, so the row is kept as NaN
+    assert np.isnan(result.values[1, 3]).all()
+    expected = ts_da.interpolate_na(dim="time", fill_value="extrapolate")
+    np.testing.assert_allclose(result.values[1, :3], expected.values[1, :3])
+
+
+def test_fill_gaps_interpolate_float32(ts_da):
+    expected = ts_da.interpolate_na(dim="time", fill_value="extrapolate")
+    result = _fill_gaps_da(ts_da.astype(np.float32), fill_nan="interpolate")
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork is not available")
+def test_fork_after_fill_gaps():
+    """The process must still exit after forking a child once gaps are filled
+
+    Parallel numba kernels (with the TBB threading layer) make it hang at exit,
+    so we run it in a subprocess with a timeout
+    """
+    script = textwrap.dedent("""
+        import os
+        import numpy as np
+        import xarray as xr
+        from torchhydro.datasets.data_sets import _fill_gaps_da
+
+        # run the kernels in threads even on a single-CPU machine
+        os.cpu_count = lambda: 4
+        data = np.random.rand(3, 5, 50)
+        data[data < 0.3] = np.nan
+        da = xr.DataArray(data, dims=("variable", "basin", "time"))
+        _fill_gaps_da(da, fill_nan="interpolate")
+        _fill_gaps_da(da.isel(time=0), fill_nan="mean")
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        """)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [repo_dir] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=env, timeout=300, capture_output=True
+    )
+    assert result.returncode == 0, result.stderr.decode()
+
+
+def test_fill_gaps_mean(ts_da):
+    # prcp has data in some basin at all times, so NaNs are filled with the means
+    ts_da[0, 3] = 3.0
+    ts_da[0, :, 4] = [np.nan, 1.0, np.nan, 3.0]
+    # all basins of pet are NaN at one time, so all NaNs of pet are filled with -1
+    ts_da[1, :, 7] = np.nan
+    mean_val = ts_da.mean(dim="basin", skipna=True)
+    expected = ts_da.copy()
+    expected[0] = ts_da[0].fillna(mean_val[0])
+    expected[1] = ts_da[1].fillna(-1)
+    result = _fill_gaps_da(ts_da.copy(), fill_nan="mean")
+    assert result.dims == ts_da.dims
+    np.testing.assert_allclose(result.values, expected.values)
+    np.testing.assert_allclose(result.values[0, [0, 2], 4], 2.0)
+    np.testing.assert_array_equal(result.values[1, :, 7], -1)
+
+
+def test_fill_gaps_mean_attributes():
+    da = xr.DataArray(
+        np.array([[1.0, np.nan, 3.0], [np.nan, np.nan, np.nan]]),
+        dims=("variable", "basin"),
+    )
+    result = _fill_gaps_da(da, fill_nan="mean")
+    np.testing.assert_array_equal(result.values, [[1.0, 2.0, 3.0], [-1, -1, -1]])
+
+
+@pytest.mark.parametrize("fill_nan", ["interpolate", "et_ssm_ignore", "mean"])
+def test_fill_gaps_in_threads(ts_da, fill_nan, monkeypatch):
+    expected = _fill_gaps_da(ts_da.copy(), fill_nan=fill_nan)
+    # split the rows into blocks and fill them in threads
+    monkeypatch.setattr(os, "cpu_count", lambda: 3)
+    result = _fill_gaps_da(ts_da.copy(), fill_nan=fill_nan)
+    np.testing.assert_array_equal(result.values, expected.values)
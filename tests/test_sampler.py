@@ -9,13 +9,14 @@ Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
 import os
+import numpy as np
 import pytest
 import hydrodataset as hds
 from hydrodataset.caravan import Caravan
 from torch.utils.data import Dataset
 
 from torchhydro import SETTING
-from torchhydro.datasets.sampler import KuaiSampler
+from torchhydro.datasets.sampler import BasinBucketedSampler, KuaiSampler
 
 
 class SimpleDataset(Dataset):
@@ -83,3 +84,27 @@ def test_cache_caravan():
         os.path.join(SETTING["local_data_path"]["datasets-origin"], "caravan")
     )
     caravan.cache_xrdataset()
+
+
+class SimpleBasinDataset(Dataset):
+    def __init__(self):
+        basin_idx = np.repeat(np.arange(3, dtype=np.int32), [5, 8, 2])
+        time_idx = np.concatenate([np.arange(5), np.arange(8), np.arange(2)])
+        self.lookup_table = np.stack((basin_idx, time_idx.astype(np.int32)), axis=-1)
+
+    def __len__(self):
+        return len(self.lookup_table)
+
+    def __getitem__(self, idx):
+        return idx
+
+
+def test_basin_bucketed_sampler():
+    dataset = SimpleBasinDataset()
+    sampler = BasinBucketedSampler(dataset)
+    samples = list(sampler)
+    assert len(samples) == len(sampler) == len(dataset)
+    assert sorted(samples) == list(range(len(dataset)))
+    # all samples of one basin are yielded one after another
+    basins = dataset.lookup_table[samples, 0]
+    assert np.count_nonzero(np.diff(basins)) == 2
@@ -207,6 +207,14 @@ def default_config_file():
                 "pbm_norm": False,
             },
             "stat_dict_file": None,
+            # if True, basin areas and attributes read from the data source are cached in
+            # memory and reused by train/valid/test datasets of the same basins
+            "cache_datasets": True,
+            # if not None, preprocessed (normalized and gap-filled) arrays are saved to this
+            # directory and later runs with the same basins, periods, variables and scaler
+            # memory-map them directly (scaler statistics are copied to their test_path);
+            # the source data are not checked, so clear this directory when they change
+            "preprocessed_cache_dir": None,
             # dataset for pytorch dataset
             "dataset": "StreamflowDataset",
             # sampler for pytorch dataloader, here we mainly use it for Kuai Fang's sampler in all his DL papers
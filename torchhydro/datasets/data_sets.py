@@ -8,17 +8,24 @@ FilePath: /torchhydro/torchhydro/datasets/data_sets.py
 Copyright (c) 2024-2024 Wenyu Ouyang. All rights reserved.
 """
 
+import hashlib
+import json
 import logging
+import os
+import pickle as pkl
 import re
-import sys
+import shutil
 import torch
+import uuid
 import xarray as xr
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import cached_property, lru_cache
 from typing import Optional
+from numba import njit
 from torch.utils.data import Dataset
-from tqdm import tqdm
 from hydrodatasource.utils.utils import streamflow_unit_conv
 
 from torchhydro.configs.config import DATE_FORMATS
@@ -33,6 +40,129 @@ from hydrodatasource.reader.data_source import HydroBasins
 
 LOGGER = logging.getLogger(__name__)
 
+# preprocessed arrays of BaseDataset which can be saved to and loaded from disk
+PREPROCESSED_ARRAYS = ("xc", "y", "c", "x_origin", "y_origin", "c_origin")
+# version of the preprocessed files, bump it when the preprocessing changes so that
+# files saved by older code are not loaded any more
+PREPROCESSED_VERSION = 2
+
+
+@njit(nogil=True, cache=True)
+def _interp_fill(arr, x):
+    """Linearly interpolate NaNs along the last axis of a 2-d array row by row
+
+    Same as scipy's interp1d(fill_value="extrapolate"): gaps between two valid values
+    are interpolated and the two ends are extrapolated with the nearest two valid values.
+    A row with only one valid value is filled with that value.
+
+    The kernel is serial on purpose: numba's parallel threading layers (TBB by default)
+    make the process hang at exit once it forks, e.g. for DataLoader workers. It is
+    run on blocks of rows in threads by _run_in_row_blocks instead.
+    """
+    out = arr.copy()
+    n_t = arr.shape[1]
+    for i in range(arr.shape[0]):
+        row = arr[i]
+        valid = np.nonzero(~np.isnan(row))[0]
+        n_valid = valid.size
+        if n_valid == 0 or n_valid == n_t:
+            continue
+        if n_valid == 1:
+            out[i, :] = row[valid[0]]
+            continue
+        k = 0
+        for j in range(n_t):
+            if not np.isnan(row[j]):
+                continue
+            while k < n_valid - 2 and valid[k + 1] < j:
+                k += 1
+            x0 = x[valid[k]]
+            x1 = x[valid[k + 1]]
+            y0 = row[valid[k]]
+            y1 = row[valid[k + 1]]
+            out[i, j] = y0 + (y1 - y0) * (x[j] - x0) / (x1 - x0)
+    return out
+
+
+@njit(nogil=True, cache=True)
+def _fill_mean(arr):
+    """Fill NaNs of a (variable, basin, rest) array with the mean across basins
+
+    The means are calculated in one sweep per variable and NaNs are filled in another.
+    When the mean of a variable is NaN somewhere (all basins are NaN there), all NaNs
+    of this variable are filled with -1. The means are returned for checking.
+    """
+    out = arr.copy()
+    n_var, n_basin, n_rest = arr.shape
+    mean = np.empty((n_var, n_rest), dtype=arr.dtype)
+    for v in range(n_var):
+        total = np.zeros(n_rest)
+        count = np.zeros(n_rest, dtype=np.int64)
+        for b in range(n_basin):
+            for r in range(n_rest):
+                if not np.isnan(arr[v, b, r]):
+                    total[r] += arr[v, b, r]
+                    count[r] += 1
+        any_nan_mean = False
+        for r in range(n_rest):
+            if count[r] > 0:
+                mean[v, r] = total[r] / count[r]
+            else:
+                mean[v, r] = np.nan
+                any_nan_mean = True
+        # when all values are NaN somewhere, the mean is NaN there, so all NaNs of this
+        # variable are filled with -1 instead of the means
+        for b in range(n_basin):
+            for r in range(n_rest):
+                if np.isnan(out[v, b, r]):
+                    out[v, b, r] = -1 if any_nan_mean else mean[v, r]
+    return out, mean
+
+
+def _run_in_row_blocks(kernel, arr, *args):
+    """Run a nogil numba kernel on blocks of rows of arr in threads, one per CPU
+
+    The rows (first axis) are independent in our kernels, so each thread works on a
+    contiguous view of arr without sharing any state. The threads are gone when this
+    function returns, so nothing is left running when the process forks later.
+    The results of the blocks (or each of them if the kernel returns a tuple) are
+    concatenated along the first axis.
+    """
+    n_workers = min(os.cpu_count() or 1, arr.shape[0])
+    if n_workers <= 1:
+        return kernel(arr, *args)
+    blocks = np.array_split(arr, n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(lambda block: kernel(block, *args), blocks))
+    if isinstance(results[0], tuple):
+        return tuple(np.concatenate(parts) for parts in zip(*results))
+    return np.concatenate(results)
+
+
+def _interp_fill_nd(arr, x):
+    """Apply _interp_fill to an array whose last axis is time"""
+    shape = arr.shape
+    arr_2d = np.ascontiguousarray(arr).reshape(-1, shape[-1])
+    return _run_in_row_blocks(_interp_fill, arr_2d, x).reshape(shape)
+
+
+def _interpolate_na_time(da: xr.DataArray) -> xr.DataArray:
+    """Same as da.interpolate_na(dim="time", fill_value="extrapolate") but for all basins at once"""
+    x = da["time"].values
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = (x - x[0]) / np.timedelta64(1, "s")
+    x = x.astype(np.float64)
+    return xr.apply_ufunc(
+        _interp_fill_nd,
+        da,
+        input_core_dims=[["time"]],
+        output_core_dims=[["time"]],
+        kwargs={"x": x},
+        dask="parallelized",
+        output_dtypes=[da.dtype],
+        keep_attrs=True,
+    ).transpose(*da.dims)
+
 
 def _fill_gaps_da(da: xr.DataArray, fill_nan: Optional[str] = None) -> xr.DataArray:
     """Fill gaps in a DataArray"""
@@ -41,42 +171,79 @@ def _fill_gaps_da(da: xr.DataArray, fill_nan: Optional[str] = None) -> xr.DataAr
     assert isinstance(da, xr.DataArray), "Expect da to be DataArray (not dataset)"
     # fill gaps
     if fill_nan == "et_ssm_ignore":
-        all_non_nan_idx = []
-        for i in range(da.shape[0]):
-            non_nan_idx_tmp = np.where(~np.isnan(da[i].values))
-            all_non_nan_idx = all_non_nan_idx + non_nan_idx_tmp[0].tolist()
-        # some NaN data appear in different dates in different basins
-        non_nan_idx = np.unique(all_non_nan_idx).tolist()
-        for i in range(da.shape[0]):
-            targ_i = da[i][non_nan_idx]
-            da[i][non_nan_idx] = targ_i.interpolate_na(
-                dim="time", fill_value="extrapolate"
-            )
+        # some NaN data appear in different dates in different basins,
+        # so we keep the union of all dates which have data in any basin
+        other_axes = tuple(
+            axis for axis in range(da.ndim) if axis != da.get_axis_num("time")
+        )
+        non_nan_idx = np.where((~np.isnan(da.values)).any(axis=other_axes))[0]
+        da[dict(time=non_nan_idx)] = _interpolate_na_time(da.isel(time=non_nan_idx))
     elif fill_nan == "mean":
-        # fill with mean
-        for var in da["variable"].values:
-            var_data = da.sel(variable=var)  # select the data for the current variable
-            mean_val = var_data.mean(
-                dim="basin"
-            )  # calculate the mean across all basins
-            if warn_if_nan(mean_val):
-                # when all value are NaN, mean_val will be NaN, we set mean_val to -1
-                mean_val = -1
-            filled_data = var_data.fillna(
-                mean_val
-            )  # fill NaN values with the calculated mean
-            da.loc[dict(variable=var)] = (
-                filled_data  # update the original dataarray with the filled data
-            )
+        # fill with the mean across all basins
+        da_vb = da.transpose("variable", "basin", ...)
+        arr = np.ascontiguousarray(da_vb.values)
+        filled, mean_val = _run_in_row_blocks(
+            _fill_mean, arr.reshape(arr.shape[0], arr.shape[1], -1)
+        )
+        warn_if_nan(xr.DataArray(mean_val))
+        da = da_vb.copy(data=filled.reshape(arr.shape)).transpose(*da.dims)
     elif fill_nan == "interpolate":
         # fill interpolation
-        for i in range(da.shape[0]):
-            da[i] = da[i].interpolate_na(dim="time", fill_value="extrapolate")
+        da = _interpolate_na_time(da)
     else:
         raise NotImplementedError(f"fill_nan {fill_nan} not implemented")
     return da
 
 
+def _data_source_from_json(source_cfgs_json: str):
+    source_cfgs = json.loads(source_cfgs_json)
+    return data_sources_dict[source_cfgs["source_name"]](source_cfgs["source_path"])
+
+
+@lru_cache(maxsize=8)
+def _read_area(source_cfgs_json: str, sites_id: tuple):
+    """Read basin areas from a data source, cached as they are the same for all periods"""
+    return _data_source_from_json(source_cfgs_json).read_area(list(sites_id))
+
+
+@lru_cache(maxsize=8)
+def _read_attr_xrdataset(source_cfgs_json: str, sites_id: tuple, var_lst: tuple):
+    """Read attributes (str-type ones are transformed to numbers) from a data source
+
+    Attributes don't change with periods, so the result is cached by the arguments and
+    train/valid/test datasets of the same basins only read them once.
+    Callers should copy the returned dataset before modifying it.
+    """
+    return _data_source_from_json(source_cfgs_json).read_attr_xrdataset(
+        list(sites_id), list(var_lst), all_number=True
+    )
+
+
+def _write_file_atomically(path: str, write) -> None:
+    """Write a file with write(f) to a temporary file, then move it to path
+
+    os.replace is atomic, so other processes (e.g. runs of a sweep sharing a cache)
+    only ever see the old or the new complete file, never a partly written one
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _to_contiguous_nparr(da: xr.DataArray, dims: tuple) -> np.ndarray:
+    """Transpose a DataArray to dims and return it as a C-contiguous float32 numpy array
+
+    float32 is what all models use, so casting once here lets __getitem__ hand out
+    tensors sharing memory with the array instead of casting every sample
+    """
+    return np.ascontiguousarray(da.transpose(*dims).to_numpy(), dtype=np.float32)
+
+
 def detect_date_format(date_str):
     for date_format in DATE_FORMATS:
         try:
@@ -90,6 +257,28 @@ def detect_date_format(date_str):
 class BaseDataset(Dataset):
     """Base data set class to load and preprocess data (batch-first) using PyTorch's Dataset"""
 
+    # data_cfgs which the preprocessed arrays depend on, the key of their cached files;
+    # subclasses reading other data_cfgs when preprocessing should add them
+    _preprocessed_cfg_keys = (
+        "source_cfgs",
+        "object_ids",
+        "t_range_train",
+        "t_range_valid",
+        "t_range_test",
+        "relevant_cols",
+        "target_cols",
+        "constant_cols",
+        "scaler",
+        "scaler_params",
+        "target_rm_nan",
+        "relevant_rm_nan",
+        "constant_rm_nan",
+        "stat_dict_file",
+        "min_time_unit",
+        "min_time_interval",
+        "warmup_length",
+    )
+
     def __init__(self, data_cfgs: dict, is_tra_val_te: str):
         """
         Parameters
@@ -116,6 +305,22 @@ class BaseDataset(Dataset):
         source_path = self.data_cfgs["source_cfgs"]["source_path"]
         return data_sources_dict[source_name](source_path)
 
+    @property
+    def _source_cfgs_json(self):
+        """source_cfgs as a json string, used as the hashable key of cached reads"""
+        return json.dumps(self.data_cfgs["source_cfgs"], sort_keys=True, default=str)
+
+    def _read_with_cache(self, read_func, *args):
+        """Call a lru_cache'd read function, or bypass its cache if "cache_datasets" is False
+
+        Only areas and attributes are cached, as they are the same for train/valid/test
+        datasets of the same basins; time-series data differ by period and are always
+        read again
+        """
+        if self.data_cfgs.get("cache_datasets", True):
+            return read_func(*args)
+        return read_func.__wrapped__(*args)
+
     @property
     def streamflow_name(self):
         return self.data_cfgs["target_cols"][0]
@@ -135,10 +340,13 @@ class BaseDataset(Dataset):
         """
         return len(self.basins)
 
-    @property
+    @cached_property
     def nt(self):
         """length of longest time series in all basins
 
+        It is computed only once as the time range doesn't change after loading, while
+        it is queried by the lookup table creation and the sampler setup in trainers
+
         Returns
         -------
         int
@@ -220,24 +428,66 @@ class BaseDataset(Dataset):
 
     def __getitem__(self, item: int):
         if not self.train_mode:
-            x = self.x[item, :, :]
-            y = self.y[item, :, :]
-            if self.c is None or self.c.shape[-1] == 0:
-                return torch.from_numpy(x).float(), torch.from_numpy(y).float()
-            c = self.c[item, :]
-            c = np.repeat(c, x.shape[0], axis=0).reshape(c.shape[0], -1).T
-            xc = np.concatenate((x, c), axis=1)
-            return torch.from_numpy(xc).float(), torch.from_numpy(y).float()
+            return self._xc_tensor[item], self._y_tensor[item]
         basin, idx = self.lookup_table[item]
         warmup_length = self.warmup_length
-        x = self.x[basin, idx - warmup_length : idx + self.rho + self.horizon, :]
-        y = self.y[basin, idx : idx + self.rho + self.horizon, :]
-        if self.c is None or self.c.shape[-1] == 0:
-            return torch.from_numpy(x).float(), torch.from_numpy(y).float()
-        c = self.c[basin, :]
-        c = np.repeat(c, x.shape[0], axis=0).reshape(c.shape[0], -1).T
-        xc = np.concatenate((x, c), axis=1)
-        return torch.from_numpy(xc).float(), torch.from_numpy(y).float()
+        xc = torch.as_tensor(
+            self.xc[basin, idx - warmup_length : idx + self.rho + self.horizon, :],
+            dtype=torch.float32,
+        )
+        y = torch.as_tensor(
+            self.y[basin, idx : idx + self.rho + self.horizon, :], dtype=torch.float32
+        )
+        return xc, y
+
+    def __getitems__(self, indices):
+        """Get a batch of samples at once; DataLoader calls it instead of __getitem__
+
+        Samples of the batch are gathered from xc and y by one fancy indexing rather
+        than being sliced one by one
+
+        Parameters
+        ----------
+        indices
+            indices of samples in the batch
+
+        Returns
+        -------
+        list
+            (xc, y) of each sample, the same as __getitem__
+        """
+        if type(self).__getitem__ is not BaseDataset.__getitem__:
+            # subclasses build their samples in their own __getitem__
+            return [self[i] for i in indices]
+        if not self.train_mode:
+            return list(zip(self._xc_tensor[indices], self._y_tensor[indices]))
+        basin, idx = self.lookup_table[indices].T
+        xc_time = idx[:, np.newaxis] + np.arange(
+            -self.warmup_length, self.rho + self.horizon
+        )
+        y_time = idx[:, np.newaxis] + np.arange(self.rho + self.horizon)
+        xc = torch.as_tensor(
+            self.xc[basin[:, np.newaxis], xc_time], dtype=torch.float32
+        )
+        y = torch.as_tensor(self.y[basin[:, np.newaxis], y_time], dtype=torch.float32)
+        return list(zip(xc, y))
+
+    def __getstate__(self):
+        """Leave out what DataLoader workers don't need when the dataset is pickled
+
+        target_scaler keeps a copy of the data for inverse transforms, which are only
+        done in the main process; tensors of valid/test are rebuilt from the arrays
+        """
+        state = self.__dict__.copy()
+        for key in ["target_scaler", "_xc_tensor", "_y_tensor"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not self.train_mode:
+            self._xc_tensor = torch.as_tensor(self.xc, dtype=torch.float32)
+            self._y_tensor = torch.as_tensor(self.y, dtype=torch.float32)
 
     def _pre_load_data(self):
         self.train_mode = self.is_tra_val_te == "train"
@@ -248,24 +498,151 @@ class BaseDataset(Dataset):
 
     def _load_data(self):
         self._pre_load_data()
-        self._read_xyc()
-        # normalization
-        norm_x, norm_y, norm_c = self._normalize()
-        self.x, self.y, self.c = self._kill_nan(norm_x, norm_y, norm_c)
-        self._trans2nparr()
+        if not self._load_preprocessed():
+            self._read_xyc()
+            # normalization
+            norm_x, norm_y, norm_c = self._normalize()
+            self.x, self.y, self.c = self._kill_nan(norm_x, norm_y, norm_c)
+            self._trans2nparr()
+            self._save_preprocessed()
         self._create_lookup_table()
+        if not self.train_mode:
+            # each basin is one sample in valid/test mode, so we build the tensors once
+            # here (sharing memory with the numpy arrays) and __getitem__ only indexes them
+            self._xc_tensor = torch.as_tensor(self.xc, dtype=torch.float32)
+            self._y_tensor = torch.as_tensor(self.y, dtype=torch.float32)
+
+    @property
+    def _preprocessed_file_prefix(self):
+        """Prefix of files of preprocessed data, None if "preprocessed_cache_dir" is not set
+
+        The files are keyed by a hash of PREPROCESSED_VERSION, the dataset class, the
+        mode and the data_cfgs in _preprocessed_cfg_keys, so runs only differing in
+        other settings (test_path, batch_size, ...) share them.
+        The source data themselves are not part of the key: when they change, clear
+        the cache directory, otherwise the stale files are loaded
+        """
+        cache_dir = self.data_cfgs.get("preprocessed_cache_dir")
+        if cache_dir is None:
+            return None
+        key = hashlib.sha1(
+            json.dumps(
+                [
+                    PREPROCESSED_VERSION,
+                    type(self).__name__,
+                    self.is_tra_val_te,
+                    {k: self.data_cfgs.get(k) for k in self._preprocessed_cfg_keys},
+                ],
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+        return os.path.join(cache_dir, key)
+
+    @property
+    def _scaler_stat_files(self):
+        """Files of scaler statistics that ScalerHub saves in test_path"""
+        if self.data_cfgs["scaler"] == "DapengScaler":
+            return ["dapengscaler_stat.json"]
+        return [
+            f"{key}_scaler.pkl"
+            for key in ["target_vars", "relevant_vars", "constant_vars"]
+        ]
+
+    def _load_preprocessed(self):
+        """Load preprocessed arrays and target_scaler saved by a former run
+
+        The arrays are memory-mapped (copy-on-write), so reading, normalization and
+        filling gaps are all skipped and the OS only loads the pages that are used.
+
+        Returns
+        -------
+        bool
+            True if the preprocessed data were found and loaded
+        """
+        prefix = self._preprocessed_file_prefix
+        # target_scaler is saved last, so its file means all arrays are complete
+        if prefix is None or not os.path.isfile(f"{prefix}_target_scaler.pkl"):
+            return False
+        for name in PREPROCESSED_ARRAYS:
+            file = f"{prefix}_{name}.npy"
+            arr = np.load(file, mmap_mode="c") if os.path.isfile(file) else None
+            setattr(self, name, arr)
+        with open(f"{prefix}_target_scaler.pkl", "rb") as f:
+            self.target_scaler = pkl.load(f)
+        # the statistics of the cached data are needed in test_path by later datasets
+        # (valid/test) and by the evaluation, as if the data were normalized here
+        for name in self._scaler_stat_files:
+            if os.path.isfile(f"{prefix}_{name}"):
+                shutil.copy(
+                    f"{prefix}_{name}", os.path.join(self.data_cfgs["test_path"], name)
+                )
+        nc = 0 if self.c is None else self.c.shape[-1]
+        self.x = self.xc[:, :, : self.xc.shape[-1] - nc]
+        LOGGER.info(f"Preprocessed data loaded from {prefix}_*.npy")
+        return True
+
+    def _save_preprocessed(self):
+        """Save preprocessed arrays and target_scaler for _load_preprocessed"""
+        prefix = self._preprocessed_file_prefix
+        if prefix is None:
+            return
+        try:
+            target_scaler = pkl.dumps(self.target_scaler)
+        except Exception as e:
+            LOGGER.warning(f"Preprocessed data are not saved as {e}")
+            return
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        # every file is moved into place only when complete, and target_scaler comes
+        # last, so concurrent runs never load (or memory-map) partly written files
+        for name in PREPROCESSED_ARRAYS:
+            arr = getattr(self, name)
+            if arr is not None:
+                _write_file_atomically(
+                    f"{prefix}_{name}.npy", lambda f: np.save(f, np.asarray(arr))
+                )
+        for name in self._scaler_stat_files:
+            stat_file = os.path.join(self.data_cfgs["test_path"], name)
+            if os.path.isfile(stat_file):
+                with open(stat_file, "rb") as src:
+                    _write_file_atomically(
+                        f"{prefix}_{name}", lambda f: shutil.copyfileobj(src, f)
+                    )
+        _write_file_atomically(
+            f"{prefix}_target_scaler.pkl", lambda f: f.write(target_scaler)
+        )
 
     def _trans2nparr(self):
         """To make __getitem__ more efficient,
-        we transform x, y, c to numpy array with shape (nsample, nt, nvar)
+        we transform x, y, c to float32 numpy array with shape (nsample, nt, nvar)
+
+        The arrays are made C-contiguous once here, because transpose only gives a
+        strided view and every sample sliced from it would be scattered in memory
         """
-        self.x = self.x.transpose("basin", "time", "variable").to_numpy()
-        self.y = self.y.transpose("basin", "time", "variable").to_numpy()
+        self.x = _to_contiguous_nparr(self.x, ("basin", "time", "variable"))
+        self.y = _to_contiguous_nparr(self.y, ("basin", "time", "variable"))
         if self.c is not None and self.c.shape[-1] > 0:
-            self.c = self.c.transpose("basin", "variable").to_numpy()
-            self.c_origin = self.c_origin.transpose("basin", "variable").to_numpy()
-        self.x_origin = self.x_origin.transpose("basin", "time", "variable").to_numpy()
-        self.y_origin = self.y_origin.transpose("basin", "time", "variable").to_numpy()
+            self.c = _to_contiguous_nparr(self.c, ("basin", "variable"))
+            self.c_origin = _to_contiguous_nparr(self.c_origin, ("basin", "variable"))
+            # attributes are constant in time, so we put them after x once here
+            # rather than tiling and concatenating them for every sample;
+            # x is kept as a view of xc so that no extra memory is needed
+            nx = self.x.shape[-1]
+            self.xc = np.empty(
+                self.x.shape[:-1] + (nx + self.c.shape[-1],),
+                dtype=np.result_type(self.x, self.c),
+            )
+            self.xc[:, :, :nx] = self.x
+            self.xc[:, :, nx:] = self.c[:, np.newaxis, :]
+            self.x = self.xc[:, :, :nx]
+        else:
+            self.xc = self.x
+        self.x_origin = _to_contiguous_nparr(
+            self.x_origin, ("basin", "time", "variable")
+        )
+        self.y_origin = _to_contiguous_nparr(
+            self.y_origin, ("basin", "time", "variable")
+        )
 
     def _normalize(self):
         scaler_hub = ScalerHub(
@@ -321,7 +698,9 @@ class BaseDataset(Dataset):
         if standardized_streamflow_unit != standardized_prcp_unit:
             data_output_ds = streamflow_unit_conv(
                 data_output_ds,
-                self.data_source.read_area(self.t_s_dict["sites_id"]),
+                self._read_with_cache(
+                    _read_area, self._source_cfgs_json, tuple(self.t_s_dict["sites_id"])
+                ),
                 target_unit=prcp_unit,
             )
         return data_forcing_ds, data_output_ds
@@ -334,34 +713,39 @@ class BaseDataset(Dataset):
         tuple[xr.Dataset, xr.Dataset, xr.Dataset]
             x, y, c data
         """
-        # x
-        data_forcing_ds_ = self.data_source.read_ts_xrdataset(
+        relevant_cols = list(self.data_cfgs["relevant_cols"])
+        target_cols = list(self.data_cfgs["target_cols"])
+        # x and y are read in one pass over the same basins and periods, then split
+        data_ts_ds = self.data_source.read_ts_xrdataset(
             self.t_s_dict["sites_id"],
             self.t_s_dict["t_final_range"],
-            self.data_cfgs["relevant_cols"],
+            list(dict.fromkeys(relevant_cols + target_cols)),
         )
+        # x
+        data_forcing_ds_ = data_ts_ds[relevant_cols]
         # y
-        data_output_ds_ = self.data_source.read_ts_xrdataset(
-            self.t_s_dict["sites_id"],
-            self.t_s_dict["t_final_range"],
-            self.data_cfgs["target_cols"],
-        )
+        data_output_ds_ = data_ts_ds[target_cols]
         data_forcing_ds, data_output_ds = self._check_ts_xrds_unit(
             data_forcing_ds_, data_output_ds_
         )
         # c
-        data_attr_ds = self.data_source.read_attr_xrdataset(
-            self.t_s_dict["sites_id"],
-            self.data_cfgs["constant_cols"],
-            all_number=True,
-        )
+        data_attr_ds = self._read_with_cache(
+            _read_attr_xrdataset,
+            self._source_cfgs_json,
+            tuple(self.t_s_dict["sites_id"]),
+            tuple(self.data_cfgs["constant_cols"]),
+        ).copy(deep=True)
         self.x_origin, self.y_origin, self.c_origin = self._to_dataarray_with_unit(
             data_forcing_ds, data_output_ds, data_attr_ds
         )
 
     def _trans2da_and_setunits(self, ds):
-        """Set units for dataarray transfromed from dataset"""
-        result = ds.to_array(dim="variable")
+        """Set units for dataarray transfromed from dataset
+
+        Data are cast to float32 here as models use float32, so that all the following
+        steps (normalization, filling gaps, ...) work on half the bytes of float64
+        """
+        result = ds.astype(np.float32, copy=False).to_array(dim="variable")
         units_dict = {
             var: ds[var].attrs["units"]
             for var in ds.variables
@@ -377,13 +761,13 @@ class BaseDataset(Dataset):
         c_rm_nan = data_cfgs["constant_rm_nan"]
         if x_rm_nan:
             # As input, we cannot have NaN values
-            _fill_gaps_da(x, fill_nan="interpolate")
+            x = _fill_gaps_da(x, fill_nan="interpolate")
             warn_if_nan(x)
         if y_rm_nan:
-            _fill_gaps_da(y, fill_nan="interpolate")
+            y = _fill_gaps_da(y, fill_nan="interpolate")
             warn_if_nan(y)
         if c_rm_nan:
-            _fill_gaps_da(c, fill_nan="mean")
+            c = _fill_gaps_da(c, fill_nan="mean")
             warn_if_nan(c)
         warn_if_nan(x, nan_mode="all")
         warn_if_nan(y, nan_mode="all")
@@ -391,29 +775,37 @@ class BaseDataset(Dataset):
         return x, y, c
 
     def _create_lookup_table(self):
-        lookup = []
-        # list to collect basins ids of basins without a single training sample
-        basin_coordinates = len(self.t_s_dict["sites_id"])
+        """Create the lookup table from a sample index to the (basin, time) position
+
+        lookup_table is an int32 array with shape (num_samples, 2): the 1st column is
+        the basin index and the 2nd is the time index of the start of rho period
+        """
+        n_basin = len(self.t_s_dict["sites_id"])
         rho = self.rho
         warmup_length = self.warmup_length
         horizon = self.horizon
         max_time_length = self.nt
-        for basin in tqdm(range(basin_coordinates), file=sys.stdout, disable=False):
-            if self.is_tra_val_te != "train":
-                lookup.extend(
-                    (basin, f)
-                    for f in range(warmup_length, max_time_length - rho - horizon + 1)
-                )
-            else:
-                # some dataloader load data with warmup period, so leave some periods for it
-                # [warmup_len] -> time_start -> [rho] -> [horizon]
-                nan_array = np.isnan(self.y[basin, :, :])
-                lookup.extend(
-                    (basin, f)
-                    for f in range(warmup_length, max_time_length - rho - horizon + 1)
-                    if not np.all(nan_array[f + rho : f + rho + horizon])
-                )
-        self.lookup_table = dict(enumerate(lookup))
+        time_idx = np.arange(
+            warmup_length, max_time_length - rho - horizon + 1, dtype=np.int32
+        )
+        if self.is_tra_val_te != "train":
+            valid = np.ones((n_basin, time_idx.size), dtype=bool)
+        else:
+            # some dataloader load data with warmup period, so leave some periods for it
+            # [warmup_len] -> time_start -> [rho] -> [horizon]
+            # a sample is skipped when all its horizon targets are NaN, so we count
+            # the time steps with any non-NaN target in each horizon window of all basins
+            not_all_nan = ~np.all(np.isnan(self.y), axis=-1)
+            n_valid = np.zeros((n_basin, not_all_nan.shape[1] + 1), dtype=np.int64)
+            np.cumsum(not_all_nan, axis=1, out=n_valid[:, 1:])
+            valid = (
+                n_valid[:, time_idx + rho + horizon] - n_valid[:, time_idx + rho] > 0
+            )
+        # np.nonzero goes row by row, so samples are still ordered by basin then time
+        basin_idx, time_pos = np.nonzero(valid)
+        self.lookup_table = np.stack(
+            (basin_idx.astype(np.int32), time_idx[time_pos]), axis=-1
+        )
         self.num_samples = len(self.lookup_table)
 
 
@@ -480,54 +872,49 @@ class DplDataset(BaseDataset):
             basin, time = self.lookup_table[item]
             if self.target_as_input:
                 # y_morn and xc_norm are concatenated and used for DL model
-                y_norm = torch.from_numpy(
-                    self.y[basin, time - warmup : time + rho + horizon, :]
-                ).float()
+                y_norm = torch.as_tensor(
+                    self.y[basin, time - warmup : time + rho + horizon, :],
+                    dtype=torch.float32,
+                )
                 # the order of xc_norm and y_norm matters, please be careful!
                 z_train = torch.cat((xc_norm, y_norm), -1)
             elif self.constant_only:
                 # only use attributes data for DL model
-                z_train = torch.from_numpy(self.c[basin, :]).float()
+                z_train = torch.as_tensor(self.c[basin, :], dtype=torch.float32)
             else:
-                z_train = xc_norm.float()
+                z_train = xc_norm
             x_train = self.x_origin[basin, time - warmup : time + rho + horizon, :]
             y_train = self.y_origin[basin, time : time + rho + horizon, :]
         else:
-            x_norm = self.x[item, :, :]
             if self.target_as_input:
                 # when target_as_input is True,
-                # we need to use training data to generate pbm params
-                x_norm = self.train_dataset.x[item, :, :]
-            if self.c is None or self.c.shape[-1] == 0:
-                xc_norm = torch.from_numpy(x_norm).float()
-            else:
-                c_norm = self.c[item, :]
-                c_norm = (
-                    np.repeat(c_norm, x_norm.shape[0], axis=0)
-                    .reshape(c_norm.shape[0], -1)
-                    .T
+                # we need to use training data to generate pbm params;
+                # attributes are same in all periods, so train_dataset's xc can be used
+                xc_norm = torch.as_tensor(
+                    self.train_dataset.xc[item, :, :], dtype=torch.float32
                 )
-                xc_norm = torch.from_numpy(
-                    np.concatenate((x_norm, c_norm), axis=1)
-                ).float()
+            else:
+                xc_norm = self._xc_tensor[item]
             if self.target_as_input:
                 # when target_as_input is True,
                 # we need to use training data to generate pbm params
                 # when used as input, warmup_length not included for y
-                y_norm = torch.from_numpy(self.train_dataset.y[item, :, :]).float()
+                y_norm = torch.as_tensor(
+                    self.train_dataset.y[item, :, :], dtype=torch.float32
+                )
                 # the order of xc_norm and y_norm matters, please be careful!
                 z_train = torch.cat((xc_norm, y_norm), -1)
             elif self.constant_only:
                 # only use attributes data for DL model
-                z_train = torch.from_numpy(self.c[item, :]).float()
+                z_train = torch.as_tensor(self.c[item, :], dtype=torch.float32)
             else:
                 z_train = xc_norm
             x_train = self.x_origin[item, :, :]
             y_train = self.y_origin[item, warmup:, :]
         return (
-            torch.from_numpy(x_train).float(),
+            torch.as_tensor(x_train, dtype=torch.float32),
             z_train,
-        ), torch.from_numpy(y_train).float()
+        ), torch.as_tensor(y_train, dtype=torch.float32)
 
     def __len__(self):
         return self.num_samples if self.train_mode else len(self.t_s_dict["sites_id"])
@@ -536,6 +923,8 @@ class DplDataset(BaseDataset):
 class FlexibleDataset(BaseDataset):
     """A dataset whose datasources are from multiple sources according to the configuration"""
 
+    _preprocessed_cfg_keys = BaseDataset._preprocessed_cfg_keys + ("var_to_source_map",)
+
     def __init__(self, data_cfgs: dict, is_tra_val_te: str):
         super(FlexibleDataset, self).__init__(data_cfgs, is_tra_val_te)
 
@@ -705,7 +1094,7 @@ class Seq2SeqDataset(HydroMeanDataset):
         x = np.concatenate((p[:rho], s), axis=1)
 
         c = self.c[basin, :]
-        c = np.tile(c, (rho + horizon, 1))
+        c = np.broadcast_to(c, (rho + horizon, c.shape[0]))
         x = np.concatenate((x, c[:rho]), axis=1)
 
         x_h = np.concatenate((p[rho:], c[rho:]), axis=1)
@@ -713,14 +1102,14 @@ class Seq2SeqDataset(HydroMeanDataset):
 
         if self.is_tra_val_te == "train":
             return [
-                torch.from_numpy(x).float(),
-                torch.from_numpy(x_h).float(),
-                torch.from_numpy(y).float(),
-            ], torch.from_numpy(y).float()
+                torch.as_tensor(x, dtype=torch.float32),
+                torch.as_tensor(x_h, dtype=torch.float32),
+                torch.as_tensor(y, dtype=torch.float32),
+            ], torch.as_tensor(y, dtype=torch.float32)
         return [
-            torch.from_numpy(x).float(),
-            torch.from_numpy(x_h).float(),
-        ], torch.from_numpy(y).float()
+            torch.as_tensor(x, dtype=torch.float32),
+            torch.as_tensor(x_h, dtype=torch.float32),
+        ], torch.as_tensor(y, dtype=torch.float32)
 
 
 class TransformerDataset(Seq2SeqDataset):
@@ -737,13 +1126,13 @@ class TransformerDataset(Seq2SeqDataset):
         x = np.stack((p[:rho], s), axis=1)
 
         c = self.c[basin, :]
-        c = np.tile(c, (rho + horizon, 1))
+        c = np.broadcast_to(c, (rho + horizon, c.shape[0]))
         x = np.concatenate((x, c[:rho]), axis=1)
 
         x_h = np.concatenate((p[rho:].reshape(-1, 1), c[rho:]), axis=1)
         y = self.y[basin, idx + rho + 1 : idx + rho + horizon + 1, :]
 
         return [
-            torch.from_numpy(x).float(),
-            torch.from_numpy(x_h).float(),
-        ], torch.from_numpy(y).float()
+            torch.as_tensor(x, dtype=torch.float32),
+            torch.as_tensor(x_h, dtype=torch.float32),
+        ], torch.as_tensor(y, dtype=torch.float32)
@@ -131,6 +131,43 @@ class HydroSampler(Sampler[int]):
         return self.num_samples
 
 
+class BasinBucketedSampler(Sampler[int]):
+    """
+    A sampler which iterates over the samples basin by basin. Basins are visited in a
+    random order and the samples of each basin are shuffled, so consecutive samples
+    (hence most samples of a batch) come from the same basin and are read from one
+    contiguous slice of the dataset's arrays.
+
+    Parameters:
+    - data_source (BaseDataset): The dataset to sample from, expected to have a `lookup_table` attribute
+      whose rows are sorted by basin.
+    - generator: A PyTorch Generator object for random number generation (optional).
+    """
+
+    data_source: BaseDataset
+
+    def __init__(self, data_source: BaseDataset, generator=None) -> None:
+        self.data_source = data_source
+        self.generator = generator
+
+    def __iter__(self) -> Iterator[int]:
+        if self.generator is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+        else:
+            generator = self.generator
+        # samples of one basin are contiguous in the lookup table
+        counts = np.bincount(self.data_source.lookup_table[:, 0])
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        for basin in torch.randperm(len(counts), generator=generator).tolist():
+            basin_samples = torch.randperm(int(counts[basin]), generator=generator)
+            yield from (basin_samples + int(starts[basin])).tolist()
+
+    def __len__(self) -> int:
+        return len(self.data_source)
+
+
 def fl_sample_basin(dataset: BaseDataset):
     """
     Sample one basin data as a client from a dataset for federated learning
@@ -148,25 +185,20 @@ def fl_sample_basin(dataset: BaseDataset):
     basins = dataset.basins
     # one basin is one user
     num_users = len(basins)
-    # set group for basins
-    basin_groups = defaultdict(list)
-    for idx, (basin, date) in lookup_table.items():
-        basin_groups[basin].append(idx)
 
     # one user is one basin
     user_basins = defaultdict(list)
-    for i, basin in enumerate(basins):
+    for i in range(len(basins)):
         user_id = i % num_users
-        user_basins[user_id].append(basin)
+        user_basins[user_id].append(i)
 
     # a lookup_table subset for each user
     user_lookup_tables = {}
-    for user_id, basins in user_basins.items():
-        user_lookup_table = {}
-        for basin in basins:
-            for idx in basin_groups[basin]:
-                user_lookup_table[idx] = lookup_table[idx]
-        user_lookup_tables[user_id] = user_lookup_table
+    for user_id, basin_idxs in user_basins.items():
+        idxs = np.flatnonzero(np.isin(lookup_table[:, 0], basin_idxs))
+        user_lookup_tables[user_id] = {
+            idx: tuple(lookup_table[idx].tolist()) for idx in idxs.tolist()
+        }
 
     return user_lookup_tables
 
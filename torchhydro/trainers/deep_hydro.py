@@ -33,6 +33,7 @@ from torchhydro.datasets.sampler import (
     fl_sample_basin,
     fl_sample_region,
     HydroSampler,
+    BasinBucketedSampler,
 )
 from torchhydro.models.model_dict_function import (
     pytorch_criterion_dict,
@@ -500,13 +501,19 @@ class DeepHydro(DeepHydroInterface):
 
     def _get_dataloader(self, training_cfgs, data_cfgs):
         worker_num = 0
-        pin_memory = False
+        # pinned host memory lets batches be copied to GPU asynchronously
+        pin_memory = self.device.type == "cuda"
         if "num_workers" in training_cfgs:
             worker_num = training_cfgs["num_workers"]
             print(f"using {str(worker_num)} workers")
         if "pin_memory" in training_cfgs:
             pin_memory = training_cfgs["pin_memory"]
             print(f"Pin memory set to {str(pin_memory)}")
+        # opt-in: keep workers (and their copies of the datasets) alive across epochs
+        # rather than re-creating them every epoch
+        persistent_workers = (
+            training_cfgs.get("persistent_workers", False) and worker_num > 0
+        )
         train_dataset: BaseDataset = self.traindataset
         sampler = None
         if data_cfgs["sampler"] is not None:
@@ -530,6 +537,8 @@ class DeepHydro(DeepHydroInterface):
                 )
             elif data_cfgs["sampler"] == "DistSampler":
                 sampler = DistributedSampler(train_dataset)
+            elif data_cfgs["sampler"] == "BasinBucketedSampler":
+                sampler = BasinBucketedSampler(train_dataset)
             else:
                 raise NotImplementedError("This sampler not implemented yet")
         data_loader = DataLoader(
@@ -539,6 +548,7 @@ class DeepHydro(DeepHydroInterface):
             sampler=sampler,
             num_workers=worker_num,
             pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
             timeout=0,
         )
         if data_cfgs["t_range_valid"] is not None:
@@ -553,6 +563,7 @@ class DeepHydro(DeepHydroInterface):
                 shuffle=False,
                 num_workers=worker_num,
                 pin_memory=pin_memory,
+                persistent_workers=persistent_workers,
                 timeout=0,
             )
             return data_loader, validation_data_loader
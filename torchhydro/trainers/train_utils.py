@@ -47,24 +47,24 @@ def model_infer(seq_first, device, model, xs, ys):
     if type(xs) is list:
         xs = [
             (
-                data_tmp.permute([1, 0, 2]).to(device)
+                data_tmp.permute([1, 0, 2]).to(device, non_blocking=True)
                 if seq_first and data_tmp.ndim == 3
-                else data_tmp.to(device)
+                else data_tmp.to(device, non_blocking=True)
             )
             for data_tmp in xs
         ]
     else:
         xs = [
             (
-                xs.permute([1, 0, 2]).to(device)
+                xs.permute([1, 0, 2]).to(device, non_blocking=True)
                 if seq_first and xs.ndim == 3
-                else xs.to(device)
+                else xs.to(device, non_blocking=True)
             )
         ]
     ys = (
-        ys.permute([1, 0, 2]).to(device)
+        ys.permute([1, 0, 2]).to(device, non_blocking=True)
         if seq_first and ys.ndim == 3
-        else ys.to(device)
+        else ys.to(device, non_blocking=True)
     )
     output = model(*xs)
     if type(output) is tuple: